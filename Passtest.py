@@ -1,240 +1,789 @@
 import os
+import sys
 import json
 import base64
 import secrets
 import hashlib
-from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
-from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.backends import default_backend
+import hmac
+import time
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+import cbor2
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
+
+
+def _pbkdf2_sha256_fallback(password, salt, iterations, dklen=32):
+    """Pure Python PBKDF2-HMAC-SHA256 for builds where hashlib lacks it"""
+    if len(password) > 64:
+        password = hashlib.sha256(password).digest()
+    key_block = password.ljust(64, b'\0')
+    
+    # Hash the padded key blocks once and copy them for every round
+    inner = hashlib.sha256(bytes(b ^ 0x36 for b in key_block))
+    outer = hashlib.sha256(bytes(b ^ 0x5c for b in key_block))
+    
+    def hmac_sha256(msg):
+        h = inner.copy()
+        h.update(msg)
+        h2 = outer.copy()
+        h2.update(h.digest())
+        return h2.digest()
+    
+    derived = b''
+    block_index = 1
+    while len(derived) < dklen:
+        prev = hmac_sha256(salt + block_index.to_bytes(4, 'big'))
+        acc = int.from_bytes(prev, 'big')
+        for _ in range(iterations - 1):
+            prev = hmac_sha256(prev)
+            acc ^= int.from_bytes(prev, 'big')
+        derived += acc.to_bytes(32, 'big')
+        block_index += 1
+    return derived[:dklen]
+
+
+if hasattr(hashlib, 'pbkdf2_hmac'):
+    # OpenSSL's PBKDF2 already reuses the ipad/opad contexts between rounds
+    def _pbkdf2_sha256(password, salt, iterations, dklen=32):
+        return hashlib.pbkdf2_hmac('sha256', password, salt, iterations, dklen=dklen)
+else:
+    _pbkdf2_sha256 = _pbkdf2_sha256_fallback
+
+# Value of the 'wrap' field on master-key records wrapped by wrap_key
+KEY_WRAP = 'chacha20poly1305'
+
+# hashlib.pbkdf2_hmac releases the GIL, so threads are enough to use every core
+_POOL = ThreadPoolExecutor(max_workers=os.cpu_count())
+
 
 class SecurePasswordManager:
+    # Recovery codes issued per account
+    RECOVERY_CODE_COUNT = 10
+    # PBKDF2 iterations for accounts created before calibration was added
+    DEFAULT_ITERATIONS = 100000
+    # New accounts get as many iterations as fit in this time (never fewer than the default)
+    TARGET_KDF_MS = 250
+    # Derived keys are cached so repeated logins skip PBKDF2
+    KEY_CACHE_SIZE = 128
+    KEY_CACHE_TTL = 60  # seconds
+    # AESGCM instances are cached so the AES key schedule is reused
+    AEAD_CACHE_SIZE = 32
+    # Unbuffered saves are debounced and written in one go after this delay
+    FLUSH_DELAY = 0.2  # seconds
+    # Users are stored one shard file each and only this many are kept loaded
+    USER_CACHE_SIZE = 256
+    # Sessions hold the unlocked master key for this long after login
+    SESSION_TTL = 5 * 60  # seconds
+    # Failed login/recovery attempts allowed per username within the window
+    MAX_FAILED_ATTEMPTS = 5
+    ATTEMPT_WINDOW = 60  # seconds
+    # Per-process secret keying the key-cache lookups and the dummy PBKDF2 salts
+    _secret = os.urandom(32)
+    
     def __init__(self):
-        self.users = {}
-        self.db_file = "secure_password_db.json"
+        self.db_dir = "secure_password_db"
+        self.legacy_db_file = "secure_password_db.json"
+        self._index = {}  # username -> shard id
+        self._users_lru = OrderedDict()
+        self._dirty_users = set()
+        self._index_dirty = False
+        self._key_cache = OrderedDict()
+        self._key_cache_lock = threading.Lock()
+        self._aead_cache = OrderedDict()
+        self._aead_cache_lock = threading.Lock()
+        self._dirty = False
+        self._buffer_depth = 0
+        self._flush_timer = None
+        self._db_lock = threading.RLock()
+        self._sessions = {}
+        self._iterations = None
+        self._failed_attempts = defaultdict(deque)
+        self._last_attempt_sweep = time.monotonic()
         self.load_database()
+        # Calibrate up front so the first request doesn't pay for it
+        self.calibrate_iterations()
+    
+    def __del__(self):
+        # Don't leave derived keys lying around in memory
+        with self._key_cache_lock:
+            for cache_key in list(self._key_cache):
+                self._evict_key(cache_key)
+        for token in list(self._sessions):
+            self.logout(token)
+        with self._aead_cache_lock:
+            self._aead_cache.clear()
     
     def load_database(self):
+        """Load the username index; user records are loaded on demand"""
         try:
-            with open(self.db_file, 'r') as f:
-                self.users = json.load(f)
+            with open(os.path.join(self.db_dir, "index.cbor"), 'rb') as f:
+                self._index = cbor2.load(f)
+        except FileNotFoundError:
+            # Move users from the older JSON database into shards
+            for username, user_data in self.load_legacy_database().items():
+                self._add_user(username, user_data)
+            if self._index:
+                self.save_database()
+        except cbor2.CBORDecodeError:
+            self._index = {}
+    
+    def load_legacy_database(self):
+        """Load users from the old base64 + JSON database, if there is one"""
+        try:
+            with open(self.legacy_db_file, 'r') as f:
+                users = json.load(f)
         except (FileNotFoundError, json.JSONDecodeError):
-            self.users = {}
+            return {}
+        
+        for user_data in users.values():
+            user_data['salt'] = base64.b64decode(user_data['salt'])
+            user_data['encrypted_master_key'] = base64.b64decode(user_data['encrypted_master_key'])
+            user_data['passwords'] = {
+                service: base64.b64decode(encrypted_password)
+                for service, encrypted_password in user_data['passwords'].items()
+            }
+            # These use the old 16-byte-iv layout without AAD until they are overwritten
+            user_data['legacy_passwords'] = list(user_data['passwords'])
+            for recovery_entry in user_data['recovery_data']:
+                recovery_entry['salt'] = base64.b64decode(recovery_entry['salt'])
+                recovery_entry['encrypted_key'] = base64.b64decode(recovery_entry['encrypted_key'])
+        return users
     
-    def save_database(self):
-        with open(self.db_file, 'w') as f:
-            json.dump(self.users, f)
+    def _shard_file(self, shard_id):
+        return os.path.join(self.db_dir, f"u_{shard_id}.cbor")
+    
+    def _get_user(self, username):
+        """Return the record for username, loading its shard if needed"""
+        with self._db_lock:
+            user_data = self._users_lru.get(username)
+            if user_data is None:
+                with open(self._shard_file(self._index[username]), 'rb') as f:
+                    user_data = cbor2.load(f)
+                self._cache_user(username, user_data)
+            else:
+                self._users_lru.move_to_end(username)
+            return user_data
+    
+    def _add_user(self, username, user_data):
+        """Register a new user under a fresh shard id"""
+        with self._db_lock:
+            self._index[username] = secrets.token_hex(8)
+            self._index_dirty = True
+            self._dirty_users.add(username)
+            self._cache_user(username, user_data)
+    
+    def _cache_user(self, username, user_data):
+        """Keep user_data loaded, evicting the least recently used user if full"""
+        self._users_lru[username] = user_data
+        self._users_lru.move_to_end(username)
+        if len(self._users_lru) > self.USER_CACHE_SIZE:
+            evicted, evicted_data = self._users_lru.popitem(last=False)
+            # Unsaved changes have to reach disk before the record is dropped
+            if evicted in self._dirty_users:
+                self._write_file(self._shard_file(self._index[evicted]), evicted_data)
+                self._dirty_users.discard(evicted)
+    
+    def _write_file(self, path, data):
+        """Write data as CBOR, replacing path atomically"""
+        os.makedirs(self.db_dir, exist_ok=True)
+        tmp_file = path + ".tmp"
+        with open(tmp_file, 'wb') as f:
+            cbor2.dump(data, f)
+        os.replace(tmp_file, path)
+    
+    def save_database(self, username=None):
+        """Mark username's record (if given) as changed and schedule a write"""
+        with self._db_lock:
+            if username is not None:
+                self._dirty_users.add(username)
+            self._dirty = True
+            if self._buffer_depth > 0:
+                return
+            if self._flush_timer is None:
+                self._flush_timer = threading.Timer(self.FLUSH_DELAY, self._flush)
+                self._flush_timer.start()
+    
+    @contextmanager
+    def buffered(self):
+        """Hold back database writes until the block exits, then write once"""
+        with self._db_lock:
+            self._buffer_depth += 1
+        try:
+            yield self
+        finally:
+            with self._db_lock:
+                self._buffer_depth -= 1
+                if self._buffer_depth == 0 and self._dirty:
+                    self._flush()
+    
+    def _flush(self):
+        """Write changed user shards and the index, replacing each file atomically"""
+        with self._db_lock:
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+            if not self._dirty:
+                return
+            for username in self._dirty_users:
+                self._write_file(self._shard_file(self._index[username]), self._users_lru[username])
+            self._dirty_users.clear()
+            # The index only changes when users are added
+            if self._index_dirty:
+                self._write_file(os.path.join(self.db_dir, "index.cbor"), self._index)
+                self._index_dirty = False
+            self._dirty = False
     
     def generate_salt(self, length=16):
         """Generate a cryptographically secure random salt"""
         return os.urandom(length)
     
-    def derive_key(self, password, salt, iterations=100000):
+    def generate_recovery_codes(self, count=RECOVERY_CODE_COUNT, length=8):
+        """Generate numeric recovery codes from a single batch of random bytes"""
+        digits = []
+        while len(digits) < count * length:
+            # Bytes >= 250 are rejected so every digit stays equally likely
+            raw = secrets.token_bytes(2 * count * length)
+            digits.extend(chr(48 + b % 10) for b in raw if b < 250)
+        return [''.join(digits[i * length:(i + 1) * length]) for i in range(count)]
+    
+    def _evict_key(self, cache_key):
+        """Drop a cached key and overwrite its bytes with zeros"""
+        key, _ = self._key_cache.pop(cache_key)
+        key[:] = bytes(len(key))
+    
+    def derive_key(self, password, salt, iterations=DEFAULT_ITERATIONS):
+        """Derive an encryption key from password, using the key cache when possible"""
+        # Keyed hash, so the cache doesn't hold a fast, crackable hash of the password
+        password_mac = hmac.new(self._secret, password.encode(), hashlib.sha256).digest()
+        cache_key = (password_mac, bytes(salt), iterations)
+        
+        with self._key_cache_lock:
+            now = time.monotonic()
+            
+            # Evict entries unused for longer than the TTL (oldest first)
+            while self._key_cache:
+                oldest = next(iter(self._key_cache))
+                if now - self._key_cache[oldest][1] <= self.KEY_CACHE_TTL:
+                    break
+                self._evict_key(oldest)
+            
+            entry = self._key_cache.get(cache_key)
+            if entry is not None:
+                # Refresh the timestamp so the cache stays ordered oldest first
+                self._key_cache[cache_key] = (entry[0], now)
+                self._key_cache.move_to_end(cache_key)
+                return bytes(entry[0])
+        
+        # Derive outside the lock so parallel derivations don't serialize
+        key = self._derive_key_uncached(password, salt, iterations)
+        with self._key_cache_lock:
+            self._key_cache[cache_key] = (bytearray(key), time.monotonic())
+            self._key_cache.move_to_end(cache_key)
+            if len(self._key_cache) > self.KEY_CACHE_SIZE:
+                self._evict_key(next(iter(self._key_cache)))
+        return key
+    
+    def derive_keys(self, pairs, iterations=DEFAULT_ITERATIONS):
+        """Derive keys for several (password, salt) pairs in parallel"""
+        return list(_POOL.map(lambda pair: self.derive_key(pair[0], pair[1], iterations), pairs))
+    
+    def calibrate_iterations(self):
+        """Pick a PBKDF2 iteration count that takes about TARGET_KDF_MS on this machine
+        
+        The count is measured once and kept in the database directory, so later
+        runs reuse it instead of timing PBKDF2 again.
+        """
+        if self._iterations is not None:
+            return self._iterations
+        
+        settings_file = os.path.join(self.db_dir, "settings.cbor")
+        try:
+            with open(settings_file, 'rb') as f:
+                iterations = cbor2.load(f)['iterations']
+            # A damaged or edited file must never lower the floor
+            if isinstance(iterations, int) and not isinstance(iterations, bool):
+                self._iterations = max(self.DEFAULT_ITERATIONS, iterations)
+                return self._iterations
+        except (FileNotFoundError, KeyError, TypeError, cbor2.CBORDecodeError):
+            pass
+        
+        start = time.perf_counter()
+        _pbkdf2_sha256(b'x', b'x' * 16, self.DEFAULT_ITERATIONS)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        iterations = int(self.DEFAULT_ITERATIONS * self.TARGET_KDF_MS / max(elapsed_ms, 1e-3))
+        # Round to a whole thousand and never go below the default
+        self._iterations = max(self.DEFAULT_ITERATIONS, iterations // 1000 * 1000)
+        with self._db_lock:
+            self._write_file(settings_file, {'iterations': self._iterations})
+        return self._iterations
+    
+    def _derive_key_uncached(self, password, salt, iterations):
         """Derive an encryption key from password using PBKDF2"""
-        kdf = PBKDF2HMAC(
-            algorithm=hashes.SHA256(),
-            length=32,  # 256-bit key
-            salt=salt,
-            iterations=iterations,
-            backend=default_backend()
-        )
-        return kdf.derive(password.encode())
-    
-    def encrypt_data(self, data, key):
-        """Encrypt data using AES-GCM"""
-        iv = os.urandom(16)  # Initialization vector
-        cipher = Cipher(
-            algorithms.AES(key),
-            modes.GCM(iv),
-            backend=default_backend()
-        )
-        encryptor = cipher.encryptor()
-        encrypted_data = encryptor.update(data) + encryptor.finalize()
-        return iv + encryptor.tag + encrypted_data
-    
-    def decrypt_data(self, encrypted_data, key):
-        """Decrypt data using AES-GCM"""
-        iv = encrypted_data[:16]
-        tag = encrypted_data[16:32]
-        ciphertext = encrypted_data[32:]
-        cipher = Cipher(
-            algorithms.AES(key),
-            modes.GCM(iv, tag),
-            backend=default_backend()
-        )
-        decryptor = cipher.decryptor()
-        return decryptor.update(ciphertext) + decryptor.finalize()
+        return _pbkdf2_sha256(password.encode(), salt, iterations, dklen=32)  # 256-bit key
+    
+    def _aead(self, key):
+        """Return a cached AESGCM instance for key (only master keys come through here)"""
+        cache_key = bytes(key)
+        with self._aead_cache_lock:
+            aesgcm = self._aead_cache.get(cache_key)
+            if aesgcm is None:
+                aesgcm = AESGCM(cache_key)
+                self._aead_cache[cache_key] = aesgcm
+            self._aead_cache.move_to_end(cache_key)
+            if len(self._aead_cache) > self.AEAD_CACHE_SIZE:
+                self._aead_cache.popitem(last=False)
+            return aesgcm
+    
+    def _forget_aead(self, key):
+        """Drop the cached AESGCM instance (and its copy of key) once key is wiped"""
+        with self._aead_cache_lock:
+            self._aead_cache.pop(bytes(key), None)
+    
+    def encrypt_data(self, data, key, aad=None):
+        """Encrypt data using AES-GCM, optionally binding it to aad"""
+        iv = os.urandom(12)  # Initialization vector (GCM standard size)
+        # Output layout: iv + ciphertext + tag
+        return iv + self._aead(key).encrypt(iv, data, aad)
+    
+    def decrypt_data(self, encrypted_data, key, aad=None):
+        """Decrypt data using AES-GCM, checking it against aad"""
+        # Slice through a memoryview so the iv and ciphertext aren't copied
+        view = memoryview(encrypted_data)
+        return self._aead(key).decrypt(view[:12], view[12:], aad)
+    
+    def decrypt_legacy_data(self, encrypted_data, key):
+        """Decrypt a record from the old JSON database (16-byte iv + tag + ciphertext)"""
+        view = memoryview(encrypted_data)
+        iv = view[:16]
+        tag = view[16:32]
+        ciphertext = view[32:]
+        # Not cached: these keys are mostly derived keys or one-off candidates
+        return AESGCM(key).decrypt(iv, bytes(ciphertext) + tag, None)
+    
+    def wrap_key(self, master_key, key):
+        """Encrypt the master key with ChaCha20-Poly1305"""
+        nonce = os.urandom(12)
+        # Output layout: nonce + ciphertext + tag
+        return nonce + ChaCha20Poly1305(key).encrypt(nonce, master_key, None)
+    
+    def unwrap_key(self, wrapped_key, key, wrap=None):
+        """Decrypt a master key; wrap is the record's 'wrap' field (None for old records)"""
+        if wrap != KEY_WRAP:
+            return self.decrypt_legacy_data(wrapped_key, key)
+        view = memoryview(wrapped_key)
+        return ChaCha20Poly1305(key).decrypt(view[:12], view[12:], None)
+    
+    def password_aad(self, username, service):
+        """Associated data that ties a stored password to its user and service"""
+        return f"{username}|{service}".encode()
     
     def create_account(self, username, master_password):
         """Create a new user account with recovery codes"""
-        if username in self.users:
+        if username in self._index:
             return False, "Username already exists", []
         
         # Generate salt for key derivation
         salt = self.generate_salt()
         
-        # Derive encryption key from master password
-        encryption_key = self.derive_key(master_password, salt)
+        # Generate recovery codes, each with its own salt
+        recovery_codes = self.generate_recovery_codes()
+        recovery_salts = [self.generate_salt() for _ in recovery_codes]
+        
+        # Derive the master password key and all recovery keys in parallel
+        iterations = self.calibrate_iterations()
+        keys = self.derive_keys([(master_password, salt)] + list(zip(recovery_codes, recovery_salts)), iterations)
+        encryption_key, recovery_keys = keys[0], keys[1:]
         
         # Generate a random master key for encrypting passwords
         master_key = os.urandom(32)
         
         # Encrypt the master key with the derived key
-        encrypted_master_key = self.encrypt_data(master_key, encryption_key)
+        encrypted_master_key = self.wrap_key(master_key, encryption_key)
         
-        # Generate recovery codes
-        recovery_codes = []
+        # Encrypt the master key with each recovery key
         recovery_data = []
-        for _ in range(10):
-            code = ''.join(secrets.choice("0123456789") for _ in range(8))
-            recovery_codes.append(code)
-            
-            # Generate a salt for this recovery code
-            recovery_salt = self.generate_salt()
-            
-            # Derive a key from the recovery code
-            recovery_key = self.derive_key(code, recovery_salt)
-            
-            # Encrypt the master key with the recovery key
-            encrypted_key = self.encrypt_data(master_key, recovery_key)
+        for recovery_salt, recovery_key in zip(recovery_salts, recovery_keys):
+            encrypted_key = self.wrap_key(master_key, recovery_key)
             
             recovery_data.append({
-                'salt': base64.b64encode(recovery_salt).decode('ascii'),
-                'encrypted_key': base64.b64encode(encrypted_key).decode('ascii')
+                'salt': recovery_salt,
+                'encrypted_key': encrypted_key,
+                'wrap': KEY_WRAP
             })
         
         # Store user data
-        self.users[username] = {
-            'salt': base64.b64encode(salt).decode('ascii'),
-            'encrypted_master_key': base64.b64encode(encrypted_master_key).decode('ascii'),
+        self._add_user(username, {
+            'salt': salt,
+            'iterations': iterations,
+            'recovery_iterations': iterations,
+            'encrypted_master_key': encrypted_master_key,
+            'wrap': KEY_WRAP,
             'passwords': {},
             'recovery_data': recovery_data
-        }
+        })
         
-        self.save_database()
+        self.save_database(username)
         return True, "Account created successfully", recovery_codes
     
-    def login(self, username, master_password):
+    def _throttled(self, kind, username):
+        """True if username has used up its failed kind ('login' or 'recovery') attempts for this window"""
+        attempts = self._failed_attempts.get((kind, username))
+        if attempts is None:
+            return False
+        now = time.monotonic()
+        while attempts and now - attempts[0] > self.ATTEMPT_WINDOW:
+            attempts.popleft()
+        if not attempts:
+            del self._failed_attempts[(kind, username)]
+            return False
+        return len(attempts) >= self.MAX_FAILED_ATTEMPTS
+    
+    def _clear_failures(self, kind, username):
+        """Forget username's failed kind attempts after a successful one"""
+        self._failed_attempts.pop((kind, username), None)
+    
+    def _record_failure(self, kind, username):
+        now = time.monotonic()
+        self._failed_attempts[(kind, username)].append(now)
+        
+        # Once per window, drop usernames whose last failure has expired so a
+        # flood of random usernames can't grow this dict without bound
+        if now - self._last_attempt_sweep > self.ATTEMPT_WINDOW:
+            self._last_attempt_sweep = now
+            for key, attempts in list(self._failed_attempts.items()):
+                if now - attempts[-1] > self.ATTEMPT_WINDOW:
+                    del self._failed_attempts[key]
+    
+    def _dummy_salt(self, username, index):
+        """Salt for dummy PBKDF2 work, stable per username so the key cache treats it like a real one"""
+        msg = f"{username}|{index}".encode()
+        return hmac.new(self._secret, msg, hashlib.sha256).digest()[:16]
+    
+    def _pad_kdf_cost(self, username, secret, spent, count=1):
+        """Run dummy PBKDF2 so a check costs count derivations at the calibrated iteration count
+        
+        spent lists the iteration counts of the real derivations already done.
+        Unknown usernames and accounts with fewer iterations (older accounts)
+        then take as long to check as a freshly created account.
+        """
+        target = self.calibrate_iterations()
+        spent = list(spent) + [0] * (count - len(spent))
+        missing = defaultdict(list)
+        for index, iterations in enumerate(spent):
+            if iterations < target:
+                missing[target - iterations].append((secret, self._dummy_salt(username, index)))
+        for iterations, pairs in missing.items():
+            self.derive_keys(pairs, iterations)
+    
+    def unlock(self, username, master_password):
         """Verify user credentials and return master key"""
-        if username not in self.users:
+        if self._throttled('login', username):
+            return False, "Too many failed attempts, try again later", None
+        
+        if username not in self._index:
+            self._pad_kdf_cost(username, master_password, [])
+            self._record_failure('login', username)
             return False, "User not found", None
         
-        user_data = self.users[username]
+        user_data = self._get_user(username)
+        iterations = user_data.get('iterations', self.DEFAULT_ITERATIONS)
         
-        # Get salt and decode it
-        salt = base64.b64decode(user_data['salt'].encode('ascii'))
+        # Get the salt
+        salt = user_data['salt']
         
         # Re-derive the encryption key
-        encryption_key = self.derive_key(master_password, salt)
+        encryption_key = self.derive_key(master_password, salt, iterations)
+        self._pad_kdf_cost(username, master_password, [iterations])
         
-        # Get and decode the encrypted master key
-        encrypted_master_key = base64.b64decode(user_data['encrypted_master_key'].encode('ascii'))
+        # Get the encrypted master key
+        encrypted_master_key = user_data['encrypted_master_key']
         
         # Decrypt the master key
         try:
-            master_key = self.decrypt_data(encrypted_master_key, encryption_key)
-            return True, "Login successful", master_key
+            master_key = self.unwrap_key(encrypted_master_key, encryption_key, user_data.get('wrap'))
         except:
+            self._record_failure('login', username)
             return False, "Invalid password", None
-    
-    def add_password(self, username, master_password, service, password):
-        """Add a password for a service"""
-        if username not in self.users:
-            return False, "User not found"
         
-        # Verify login and get master key
-        success, message, master_key = self.login(username, master_password)
+        self._clear_failures('login', username)
+        return True, "Login successful", master_key
+    
+    def login(self, username, master_password):
+        """Verify user credentials and return a session token"""
+        success, message, master_key = self.unlock(username, master_password)
         if not success:
-            return success, message
+            return success, message, None
         
-        # Encrypt the password with the master key
-        encrypted_password = self.encrypt_data(password.encode(), master_key)
+        # The token stands in for the master key until logout or expiry
+        token = secrets.token_urlsafe(16)
+        self._sessions[token] = (username, bytearray(master_key), time.monotonic())
+        return True, message, token
+    
+    def logout(self, token):
+        """End a session and wipe its copy of the master key"""
+        session = self._sessions.pop(token, None)
+        if session is not None:
+            master_key = session[1]
+            self._forget_aead(master_key)
+            master_key[:] = bytes(len(master_key))
+    
+    def _end_sessions(self, username):
+        """End every session belonging to username"""
+        for token, session in list(self._sessions.items()):
+            if session[0] == username:
+                self.logout(token)
+    
+    def _session(self, token):
+        """Return (username, master_key) for a live session, or None"""
+        now = time.monotonic()
+        for expired_token, session in list(self._sessions.items()):
+            if now - session[2] > self.SESSION_TTL:
+                self.logout(expired_token)
         
-        # Store the encrypted password
-        self.users[username]['passwords'][service] = base64.b64encode(encrypted_password).decode('ascii')
-        self.save_database()
-        return True, f"Password for {service} added successfully"
+        session = self._sessions.get(token)
+        if session is None:
+            return None
+        return session[0], bytes(session[1])
     
-    def get_password(self, username, master_password, service):
-        """Retrieve a password for a service"""
-        if username not in self.users:
-            return False, "User not found", None
+    def session_active(self, token):
+        """True if token belongs to a session that hasn't expired or been logged out"""
+        return self._session(token) is not None
+    
+    def add_password_token(self, token, service, password):
+        """Add a password for a service using a session token"""
+        session = self._session(token)
+        if session is None:
+            return False, "Session expired or invalid"
+        username, master_key = session
         
-        # Verify login and get master key
-        success, message, master_key = self.login(username, master_password)
-        if not success:
-            return success, message, None
+        # Encrypt the password with the master key, bound to this user and service
+        encrypted_password = self.encrypt_data(password.encode(), master_key, self.password_aad(username, service))
+        
+        # Store the encrypted password (under the lock, so a flush never sees half a change)
+        with self._db_lock:
+            user_data = self._get_user(username)
+            user_data['passwords'][service] = encrypted_password
+            legacy_passwords = user_data.get('legacy_passwords')
+            if legacy_passwords and service in legacy_passwords:
+                legacy_passwords.remove(service)
+            self.save_database(username)
+        return True, f"Password for {service} added successfully"
+    
+    def get_password_token(self, token, service):
+        """Retrieve a password for a service using a session token"""
+        session = self._session(token)
+        if session is None:
+            return False, "Session expired or invalid", None
+        username, master_key = session
         
-        user_data = self.users[username]
+        user_data = self._get_user(username)
         
         if service not in user_data['passwords']:
             return False, f"No password stored for {service}", None
         
-        # Get and decode the encrypted password
-        encrypted_password = base64.b64decode(user_data['passwords'][service].encode('ascii'))
+        # Get the encrypted password
+        encrypted_password = user_data['passwords'][service]
         
         # Decrypt the password
         try:
-            decrypted_password = self.decrypt_data(encrypted_password, master_key)
+            if service in user_data.get('legacy_passwords', ()):
+                decrypted_password = self.decrypt_legacy_data(encrypted_password, master_key)
+            else:
+                decrypted_password = self.decrypt_data(encrypted_password, master_key, self.password_aad(username, service))
             return True, f"Password for {service}", decrypted_password.decode()
         except:
             return False, "Failed to decrypt password", None
     
+    def add_password(self, username, master_password, service, password):
+        """Add a password for a service"""
+        success, message, token = self.login(username, master_password)
+        if not success:
+            return success, message
+        try:
+            return self.add_password_token(token, service, password)
+        finally:
+            self.logout(token)
+    
+    def get_password(self, username, master_password, service):
+        """Retrieve a password for a service"""
+        success, message, token = self.login(username, master_password)
+        if not success:
+            return success, message, None
+        try:
+            return self.get_password_token(token, service)
+        finally:
+            self.logout(token)
+    
+    def _unwrap_recovery_entries(self, recovery_data, recovery_keys):
+        """Yield (index, master_key) for each entry the candidate keys unlock"""
+        for index, (recovery_entry, recovery_key) in enumerate(zip(recovery_data, recovery_keys)):
+            # Try to decrypt the master key; a wrong key fails the tag check
+            try:
+                yield index, self.unwrap_key(recovery_entry['encrypted_key'], recovery_key, recovery_entry.get('wrap'))
+            except InvalidTag:
+                continue
+    
     def recover_account(self, username, recovery_code, new_master_password):
         """Recover account using a recovery code"""
-        if username not in self.users:
+        if self._throttled('recovery', username):
+            return False, "Too many failed attempts, try again later", None
+        
+        if username not in self._index:
+            self._pad_kdf_cost(username, recovery_code, [], self.RECOVERY_CODE_COUNT)
+            self._record_failure('recovery', username)
             return False, "User not found", None
         
-        user_data = self.users[username]
+        user_data = self._get_user(username)
+        # Recovery entries keep the count they were created with, even after
+        # the master password is re-keyed at a newer one
+        iterations = user_data.get('recovery_iterations', user_data.get('iterations', self.DEFAULT_ITERATIONS))
+        
+        # Derive the key for every recovery entry in parallel
+        recovery_salts = [entry['salt'] for entry in user_data['recovery_data']]
+        recovery_keys = self.derive_keys([(recovery_code, recovery_salt) for recovery_salt in recovery_salts], iterations)
+        self._pad_kdf_cost(username, recovery_code, [iterations] * len(recovery_salts), self.RECOVERY_CODE_COUNT)
         
-        # Try each recovery code
-        for recovery_entry in user_data['recovery_data']:
-            # Get and decode the recovery salt
-            recovery_salt = base64.b64decode(recovery_entry['salt'].encode('ascii'))
+        # Stop at the first entry whose tag verifies
+        match = next(self._unwrap_recovery_entries(user_data['recovery_data'], recovery_keys), None)
+        if match is not None:
+            index, master_key = match
             
-            # Derive a key from the recovery code
-            recovery_key = self.derive_key(recovery_code, recovery_salt)
+            # The recovery code was valid, now set a new master password
             
-            # Get and decode the encrypted master key
-            encrypted_key = base64.b64decode(recovery_entry['encrypted_key'].encode('ascii'))
+            # Generate a new salt
+            new_salt = self.generate_salt()
             
-            # Try to decrypt the master key
-            try:
-                master_key = self.decrypt_data(encrypted_key, recovery_key)
-                
-                # If we get here, the recovery code was valid
-                # Now set a new master password
-                
-                # Generate a new salt
-                new_salt = self.generate_salt()
-                
-                # Derive a new encryption key from the new master password
-                new_encryption_key = self.derive_key(new_master_password, new_salt)
-                
-                # Encrypt the master key with the new encryption key
-                new_encrypted_master_key = self.encrypt_data(master_key, new_encryption_key)
-                
-                # Update the user data
-                user_data['salt'] = base64.b64encode(new_salt).decode('ascii')
-                user_data['encrypted_master_key'] = base64.b64encode(new_encrypted_master_key).decode('ascii')
+            # Derive a new encryption key from the new master password,
+            # moving older accounts up to the calibrated iteration count
+            new_iterations = self.calibrate_iterations()
+            new_encryption_key = self.derive_key(new_master_password, new_salt, new_iterations)
+            
+            # Encrypt the master key with the new encryption key
+            new_encrypted_master_key = self.wrap_key(master_key, new_encryption_key)
+            
+            # Update the user data under the lock, so a flush never writes
+            # the new salt next to the old wrapped key
+            with self._db_lock:
+                user_data['recovery_iterations'] = iterations
+                user_data['iterations'] = new_iterations
+                user_data['salt'] = new_salt
+                user_data['encrypted_master_key'] = new_encrypted_master_key
+                user_data['wrap'] = KEY_WRAP
                 
-                # Remove the used recovery code
-                user_data['recovery_data'].remove(recovery_entry)
+                # Remove the used recovery code (order doesn't matter, so swap with the last)
+                recovery_data = user_data['recovery_data']
+                recovery_data[index] = recovery_data[-1]
+                recovery_data.pop()
                 
-                self.save_database()
-                return True, "Account recovered successfully", master_key
-            except:
-                # This recovery code didn't match, try the next one
-                continue
+                self.save_database(username)
+            
+            # Sessions opened with the old master password end here
+            self._end_sessions(username)
+            self._clear_failures('recovery', username)
+            self._clear_failures('login', username)
+            return True, "Account recovered successfully", master_key
         
         # If we get here, no valid recovery code was found
+        self._record_failure('recovery', username)
         return False, "Invalid recovery code", None
 
 
+def print_result(choice, result):
+    """Print the outcome of a menu choice from the (success, message, ...) tuple it returned"""
+    success, message = result[:2]
+    if success and choice == "1":
+        print(message)
+        print("Recovery Codes (save these in a secure place):")
+        for i, code in enumerate(result[2], 1):
+            print(f"{i}. {code}")
+    elif success and choice == "4":
+        print(f"{message}: {result[2]}")
+    else:
+        print(message)
+
+
+# Number of input lines each menu choice reads after the choice itself
+BATCH_FIELDS = {"1": 2, "2": 2, "3": 4, "4": 3, "5": 3, "6": 0}
+
+
+def run_batch(manager, lines):
+    """Run menu commands read from a script, logging in once per user"""
+    lines = iter(line.rstrip("\n") for line in lines)
+    sessions = {}  # (username, master password) -> session token
+    
+    def session(username, password):
+        token = sessions.get((username, password))
+        if token is not None and not manager.session_active(token):
+            # Long scripts can outlive SESSION_TTL; log in again
+            del sessions[username, password]
+        if (username, password) not in sessions:
+            success, message, token = manager.login(username, password)
+            if not success:
+                return message, None
+            sessions[username, password] = token
+        return "Login successful", sessions[username, password]
+    
+    # Every add in the script is written to disk in a single flush
+    with manager.buffered():
+        for choice in lines:
+            if choice not in BATCH_FIELDS:
+                print("Invalid choice. Please try again.")
+                continue
+            fields = [next(lines, None) for _ in range(BATCH_FIELDS[choice])]
+            if None in fields:
+                print("Incomplete command at end of input")
+                break
+            
+            if choice == "1":
+                print_result(choice, manager.create_account(*fields))
+            
+            elif choice == "2":
+                message, token = session(*fields)
+                print_result(choice, (token is not None, message))
+            
+            elif choice == "3":
+                username, password, service, service_password = fields
+                message, token = session(username, password)
+                if token is None:
+                    print_result(choice, (False, message))
+                    continue
+                print_result(choice, manager.add_password_token(token, service, service_password))
+            
+            elif choice == "4":
+                username, password, service = fields
+                message, token = session(username, password)
+                if token is None:
+                    print_result(choice, (False, message))
+                    continue
+                print_result(choice, manager.get_password_token(token, service))
+            
+            elif choice == "5":
+                username, recovery_code, new_password = fields
+                print_result(choice, manager.recover_account(username, recovery_code, new_password))
+                # Recovery ends the user's sessions and changes the password
+                for key in [key for key in sessions if key[0] == username]:
+                    del sessions[key]
+            
+            elif choice == "6":
+                print("Exiting...")
+                break
+    
+    for token in sessions.values():
+        manager.logout(token)
+
+
 # Interactive console for testing
 def test_secure_manager():
     manager = SecurePasswordManager()
     
+    # Commands piped in from a file run as one batch
+    if not sys.stdin.isatty():
+        run_batch(manager, sys.stdin)
+        return
+    
     print("=== Secure Password Manager ===")
     print("1. Create Account")
     print("2. Login")
@@ -249,43 +798,31 @@ def test_secure_manager():
         if choice == "1":
             username = input("Enter username: ")
             password = input("Enter master password: ")
-            success, message, recovery_codes = manager.create_account(username, password)
-            print(message)
-            if success:
-                print("Recovery Codes (save these in a secure place):")
-                for i, code in enumerate(recovery_codes, 1):
-                    print(f"{i}. {code}")
+            print_result(choice, manager.create_account(username, password))
         
         elif choice == "2":
             username = input("Enter username: ")
             password = input("Enter master password: ")
-            success, message, _ = manager.login(username, password)
-            print(message)
+            print_result(choice, manager.unlock(username, password))
         
         elif choice == "3":
             username = input("Enter username: ")
             password = input("Enter master password: ")
             service = input("Enter service name: ")
             service_password = input(f"Enter password for {service}: ")
-            success, message = manager.add_password(username, password, service, service_password)
-            print(message)
+            print_result(choice, manager.add_password(username, password, service, service_password))
         
         elif choice == "4":
             username = input("Enter username: ")
             password = input("Enter master password: ")
             service = input("Enter service name: ")
-            success, message, password = manager.get_password(username, password, service)
-            if success:
-                print(f"{message}: {password}")
-            else:
-                print(message)
+            print_result(choice, manager.get_password(username, password, service))
         
         elif choice == "5":
             username = input("Enter username: ")
             recovery_code = input("Enter recovery code: ")
             new_password = input("Enter new master password: ")
-            success, message, _ = manager.recover_account(username, recovery_code, new_password)
-            print(message)
+            print_result(choice, manager.recover_account(username, recovery_code, new_password))
         
         elif choice == "6":
             print("Exiting...")